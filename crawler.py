@@ -1,108 +1,278 @@
 import os
 import json
+import re
+import hashlib
 import time
 import asyncio
-import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_batch, Json
 from dotenv import load_dotenv
-from openai import OpenAI
+import httpx
+import openai
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 from playwright.async_api import async_playwright, Page
-from bs4 import BeautifulSoup
+from fast_langdetect import detect
 import signal
+from urllib.parse import urlparse
 
 # === Load Environment ===
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PRISMA_URL = os.getenv("PRISMA_URL")
 START_ID = 0
+GPT_MODEL = "gpt-4o-mini"
 MAX_CONCURRENT = 7  # or 10 if your computer can handle it
+FETCH_SIZE = 100
+PROMPT_CHARS = 6000
+PAGE_TIMEOUT = 30  # seconds to open a page and read its text
+GPT_TIMEOUT = 120  # seconds for extraction, including retries
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+# Hosts where many unrelated companies live under different paths
+SHARED_HOSTS = (
+    "sites.google.com",
+    "linktr.ee",
+    "shopee.vn",
+    "facebook.com",
+    "instagram.com",
+    "linkedin.com",
+    "blogspot.com",
+    "wixsite.com",
+)
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+BLOCKED_HOSTS = (
+    "doubleclick.net",
+    "googletagmanager.com",
+    "google-analytics.com",
+    "facebook.net",
+    "facebook.com",
+    "hotjar.com",
+)
 
 # === Set OpenAI key ===
 os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-client = OpenAI()
+# Retries are handled by tenacity in create_completion, so turn off the SDK's own
+client = AsyncOpenAI(
+    max_retries=0,
+    http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=MAX_CONCURRENT * 2))
+)
 
-# === PostgreSQL Connection ===
-conn = psycopg2.connect(PRISMA_URL)
-cur = conn.cursor()
+# === PostgreSQL Connection Pool ===
+POOL = ThreadedConnectionPool(1, MAX_CONCURRENT + 2, PRISMA_URL)
+
+# === Persistent GPT cache (disabled if the table can't be created) ===
+gpt_cache_enabled = True
+
+# === Per-run cache of GPT results by site ===
+domain_cache: dict[str, dict] = {}
+domain_inflight: dict[str, asyncio.Future] = {}
 
 # === Graceful Stop ===
 stop_requested = False
 
-def handle_sigint(signum, frame):
+def request_stop(message):
     global stop_requested
     stop_requested = True
-    print("\n🛑 Stop requested. Finishing current batch...")
+    print(message)
+
+def handle_sigint(signum, frame):
+    request_stop("\n🛑 Stop requested. Finishing in-flight companies...")
 
 signal.signal(signal.SIGINT, handle_sigint)
 
 # === DB and Helper Functions ===
-def fetch_companies(limit=10, start_from=0):
-    cur.execute("""
+def run_query(query, params, fetch=False):
+    conn = POOL.getconn()
+    try:
+        # `with conn` commits on success and rolls back on error
+        with conn, conn.cursor() as c:
+            c.execute(query, params)
+            return c.fetchall() if fetch else None
+    finally:
+        POOL.putconn(conn)
+
+def fetch_companies(limit=10, after_id=0):
+    return run_query("""
         SELECT id, name, website 
         FROM companies 
-        WHERE website IS NOT NULL AND product_name IS NULL AND id >= %s
+        WHERE website LIKE 'http%%' AND product_name IS NULL AND id > %s
         ORDER BY id
         LIMIT %s;
-    """, (start_from, limit))
-    return cur.fetchall()
+    """, (after_id, limit), fetch=True)
 
 def normalize_field(value):
     if isinstance(value, list):
-        value = ", ".join(map(str, value))
+        return ", ".join(map(str, value)).strip()
     elif isinstance(value, dict):
-        value = json.dumps(value, ensure_ascii=False)
+        return json.dumps(value, ensure_ascii=False).strip()
     elif value is None:
         return ""
-    return str(value).encode().decode('unicode_escape').strip()
+    return str(value).strip()
 
-def save_to_db(company_id, gpt_data):
+def ensure_pending_index():
+    # Best effort: the crawler still works without the index, just with slower fetches
+    conn = POOL.getconn()
     try:
-        cur.execute("""
-            UPDATE companies
-            SET 
-                product_name = %s,
-                product_function = %s,
-                product_location = %s,
-                product_qual = %s,
-                updated_at = NOW()
-            WHERE id = %s;
-        """, (
-            normalize_field(gpt_data.get("product_name")),
-            normalize_field(gpt_data.get("product_function")),
-            normalize_field(gpt_data.get("product_location")),
-            normalize_field(gpt_data.get("product_qual")),
-            company_id
-        ))
-        conn.commit()
-        print(f"✅ Saved to DB (Company ID {company_id})")
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        conn.autocommit = True
+        with conn.cursor() as c:
+            c.execute("SET lock_timeout = '5s';")
+            # A failed concurrent build leaves an INVALID index that IF NOT EXISTS would skip forever
+            c.execute("""
+                SELECT i.indisvalid
+                FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid
+                WHERE ic.relname = 'companies_pending_idx';
+            """)
+            row = c.fetchone()
+            if row and not row[0]:
+                c.execute("DROP INDEX CONCURRENTLY companies_pending_idx;")
+            c.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS companies_pending_idx
+                ON companies (id)
+                WHERE product_name IS NULL AND website LIKE 'http%';
+            """)
     except Exception as e:
-        print(f"❌ DB Save Error for Company ID {company_id}: {e}")
+        print(f"⚠️ Could not create companies_pending_idx, continuing without it: {e}")
+    finally:
+        try:
+            with conn.cursor() as c:
+                c.execute("RESET lock_timeout;")
+            conn.autocommit = False
+        except Exception:
+            pass
+        POOL.putconn(conn)
 
-# === AI Extraction Functions ===
-async def translate_to_english_if_needed(raw_text):
-    prompt = f"""
-You are a translation engine. Detect the language of the text below.
-If it is NOT English, translate it fully into English.
-If it is already English, return exactly the original text unchanged.
+def ensure_gpt_cache():
+    global gpt_cache_enabled
+    try:
+        run_query("""
+            CREATE TABLE IF NOT EXISTS gpt_cache (
+                prompt_hash TEXT PRIMARY KEY,
+                response JSONB NOT NULL
+            );
+        """, ())
+    except Exception as e:
+        gpt_cache_enabled = False
+        print(f"⚠️ GPT cache unavailable, continuing without it: {e}")
 
-Text:
-{raw_text[:1500]}
-""".strip()
+def get_cached_gpt(prompt_hash):
+    if not gpt_cache_enabled:
+        return None
+    try:
+        rows = run_query("SELECT response FROM gpt_cache WHERE prompt_hash = %s;", (prompt_hash,), fetch=True)
+        return rows[0][0] if rows else None
+    except Exception as e:
+        print(f"⚠️ GPT cache lookup error: {e}")
+        return None
 
+def set_cached_gpt(prompt_hash, response):
+    if not gpt_cache_enabled:
+        return
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        translated = response.choices[0].message.content.strip()
-        return translated
+        run_query("""
+            INSERT INTO gpt_cache (prompt_hash, response)
+            VALUES (%s, %s)
+            ON CONFLICT (prompt_hash) DO NOTHING;
+        """, (prompt_hash, Json(response)))
+    except Exception as e:
+        print(f"⚠️ GPT cache write error: {e}")
+
+def build_row(company_id, gpt_data):
+    return {
+        "id": company_id,
+        "product_name": normalize_field(gpt_data.get("product_name")),
+        "product_function": normalize_field(gpt_data.get("product_function")),
+        "product_location": normalize_field(gpt_data.get("product_location")),
+        "product_qual": normalize_field(gpt_data.get("product_qual")),
+    }
+
+def status_row(company_id, status):
+    return build_row(company_id, {"product_name": status})
+
+def save_batch(rows):
+    if not rows:
+        return
+    conn = POOL.getconn()
+    try:
+        # One transaction (and one commit) for the whole batch
+        with conn, conn.cursor() as c:
+            execute_batch(c, """
+                UPDATE companies
+                SET 
+                    product_name = %(product_name)s,
+                    product_function = %(product_function)s,
+                    product_location = %(product_location)s,
+                    product_qual = %(product_qual)s,
+                    updated_at = NOW()
+                WHERE id = %(id)s;
+            """, rows, page_size=len(rows))
+        print(f"✅ Saved {len(rows)} companies to DB")
+    except Exception as e:
+        print(f"❌ DB Save Error for Company IDs {[row['id'] for row in rows]}: {e}")
+    finally:
+        POOL.putconn(conn)
+
+# === AI Extraction Functions ===
+TRANSIENT_GPT_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+# Problems with the key, account or model rather than the page: every company would fail
+RUN_FATAL_GPT_ERRORS = (
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+)
+
+def is_quota_error(e):
+    # Also a 429, but the account is out of credit: retrying or waiting won't help
+    return isinstance(e, openai.RateLimitError) and getattr(e, "code", None) == "insufficient_quota"
+
+def is_transient_gpt_error(e):
+    return isinstance(e, TRANSIENT_GPT_ERRORS) and not is_quota_error(e)
+
+@retry(
+    retry=retry_if_exception(is_transient_gpt_error),
+    wait=wait_random_exponential(multiplier=1, max=20),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+async def create_completion(prompt):
+    return await client.chat.completions.create(
+        model=GPT_MODEL,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": "Return only JSON."},
+            {"role": "user", "content": prompt}
+        ]
+    )
+
+def detect_language(text_content):
+    try:
+        # fast-langdetect rejects newlines, so flatten the sample first
+        return detect(text_content[:2000].replace("\n", " "))["lang"]
     except Exception as e:
-        print(f"⚠️ Translation Error: {e}")
-        return raw_text
+        print(f"⚠️ Language detection error: {e}")
+        return None
 
-def extract_with_gpt(english_text):
-    trimmed_text = english_text[:7000]
+async def extract_with_gpt(text_content):
+    trimmed_text = text_content[:PROMPT_CHARS]
+    prompt_hash = hashlib.sha256(f"extract:{GPT_MODEL}:{trimmed_text}".encode()).hexdigest()
+    cached = await asyncio.to_thread(get_cached_gpt, prompt_hash)
+    if cached:
+        print("♻️ Using cached GPT result")
+        return cached
+
+    lang = detect_language(trimmed_text)
+    translate_note = "" if lang == "en" else """
+The text may be in any language; internally translate it to English, then extract.
+Write every extracted value in English.
+"""
     prompt = f"""
 You are analyzing a company's website content.
+{translate_note}
 
 Please extract the following, and be as detailed as possible:
 1. "product_name": List ALL products or services. Be specific, not just general (e.g., list 'Jeans, Jackets' instead of 'Clothing').
@@ -126,118 +296,248 @@ Here is the website text:
 """.strip()
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        response = await create_completion(prompt)
         result = response.choices[0].message.content
+        if not result:
+            # e.g. a refusal, which comes back with no content
+            print("❌ GPT returned no content")
+            return None
         try:
-            return json.loads(result)
+            gpt_data = json.loads(result)  # JSON mode guarantees valid JSON; kept for defense
         except json.JSONDecodeError as json_err:
             print(f"❌ GPT JSON parsing error: {json_err}")
             print(f"🔎 GPT Raw output:\n{result}")
             return None
-    except Exception as e:
+        await asyncio.to_thread(set_cached_gpt, prompt_hash, gpt_data)
+        return gpt_data
+    except (openai.BadRequestError, openai.UnprocessableEntityError) as e:
+        # Rejected for this page's content (filter, length, ...); retrying won't help
         print(f"❌ GPT API Error: {e}")
         return None
 
 # === Scraping + Processing ===
-async def process_company(company, playwright):
+# Thai, Lao, Myanmar, Khmer, kana and CJK ideographs: written without spaces between words
+NO_SPACE_CHARS = re.compile(r"[\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]")
+
+def word_count(line):
+    # Splitting on spaces sees a whole CJK/Thai sentence as one word, so count ~2 chars per word there
+    return max(len(line.split()), len(NO_SPACE_CHARS.findall(line)) // 2)
+
+def compact_text(text_content):
+    # Drop nav/footer fragments and repeated lines so the prompt budget holds real content
+    lines = dict.fromkeys(
+        line.strip() for line in text_content.splitlines()
+        if 3 <= word_count(line) <= 200
+    )
+    return "\n".join(lines) or text_content
+
+def host_matches(hostname, domains):
+    hostname = (hostname or "").lower()
+    return any(hostname == domain or hostname.endswith("." + domain) for domain in domains)
+
+def page_host(request):
+    try:
+        return urlparse(request.frame.page.main_frame.url).hostname
+    except Exception:
+        # Service worker requests have no frame
+        return None
+
+def is_third_party_tracker(request):
+    host = urlparse(request.url).hostname
+    blocked = next((domain for domain in BLOCKED_HOSTS if host_matches(host, (domain,))), None)
+    # A company whose site is e.g. a Facebook page still needs Facebook's own requests
+    return blocked is not None and not host_matches(page_host(request), (blocked,))
+
+async def block_heavy_requests(route):
+    request = route.request
+    # Never block the page we were asked to crawl, even if its own host is on the blocklist
+    if request.resource_type == "document" and request.frame.parent_frame is None:
+        await route.continue_()
+    elif request.resource_type in BLOCKED_RESOURCE_TYPES or is_third_party_tracker(request):
+        await route.abort()
+    else:
+        await route.continue_()
+
+def site_key(website):
+    parsed = urlparse(website)
+    host = (parsed.hostname or "").removeprefix("www.")
+    if host_matches(host, SHARED_HOSTS):
+        # The query can identify the tenant too, e.g. facebook.com/profile.php?id=...
+        key = host + parsed.path.rstrip("/")
+        return f"{key}?{parsed.query}" if parsed.query else key
+    return host
+
+async def process_company(company, context):
     company_id, name, website = company
     print(f"\n🔎 {name} ({website})")
 
-    if not website.startswith("http"):
-        print(f"⚠️ Skipping invalid URL: {website}")
-        return
+    key = site_key(website)
+    # Wait for a same-site crawl already in flight rather than paying for it twice
+    while key in domain_inflight:
+        await asyncio.shield(domain_inflight[key])
+    if key in domain_cache:
+        print(f"♻️ Reusing result for {key} (Company ID {company_id})")
+        return build_row(company_id, domain_cache[key])
+
+    done = asyncio.get_running_loop().create_future()
+    domain_inflight[key] = done
+    try:
+        return await crawl_company(company, context, key)
+    finally:
+        domain_inflight.pop(key, None)
+        done.set_result(None)
+
+async def read_page(page, website, name):
+    try:
+        await page.goto(website, timeout=20000, wait_until="domcontentloaded")
+    except Exception as e:
+        print(f"❌ Cannot open {website} → {e}")
+        return "[unreachable website]", None
 
-    browser = await playwright.chromium.launch(headless=True)
-    context = await browser.new_context()
+    try:
+        # Give JS-rendered sites a moment to put text in the body
+        await page.wait_for_function(
+            "() => document.body && document.body.innerText.trim().length > 0",
+            polling=250,
+            timeout=3000,
+        )
+    except Exception:
+        pass
+
+    try:
+        return None, await page.evaluate("() => document.body ? document.body.innerText : ''")
+    except Exception as e:
+        print(f"⚠️ Content unreadable for {name}: {e}")
+        return "[unreadable content]", None
+
+async def crawl_company(company, context, key):
+    company_id, name, website = company
+    page: Page = await context.new_page()
 
     try:
-        page: Page = await context.new_page()
         try:
-            await page.goto(website, timeout=20000)
-            await page.wait_for_load_state('networkidle', timeout=20000)
-            await page.wait_for_timeout(2000)  # Additional wait for dynamic loading
-        except Exception as e:
-            print(f"❌ Cannot open {website} → {e}")
-            cur.execute("""
-                UPDATE companies
-                SET product_name = %s, product_function = '', product_location = '', product_qual = '', updated_at = NOW()
-                WHERE id = %s;
-            """, ("[unreachable website]", company_id))
-            conn.commit()
-            print(f"☠️ Marked as unreachable (Company ID {company_id})")
-            return
+            status, raw_text = await asyncio.wait_for(read_page(page, website, name), timeout=PAGE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⏱️ Timed out loading {website}")
+            status, raw_text = "[timeout]", None
 
-        if page.is_closed():
-            print(f"⚠️ Page already closed for {name}. Skipping.")
-            return
+        if status:
+            print(f"☠️ Marked as {status} (Company ID {company_id})")
+            return status_row(company_id, status)
 
         try:
-            html_content = await page.content()
-            soup = BeautifulSoup(html_content, "html.parser")
-            text_content = soup.get_text(separator="\n", strip=True)
+            text_content = await asyncio.to_thread(compact_text, raw_text)
         except Exception as e:
             print(f"⚠️ Content unreadable for {name}: {e}")
-            cur.execute("""
-                UPDATE companies
-                SET product_name = %s, product_function = '', product_location = '', product_qual = '', updated_at = NOW()
-                WHERE id = %s;
-            """, ("[unreadable content]", company_id))
-            conn.commit()
             print(f"☠️ Marked as unreadable (Company ID {company_id})")
-            return
+            return status_row(company_id, "[unreadable content]")
+
+        if not text_content.strip():
+            print(f"⚠️ No visible text for {name}")
+            print(f"☠️ Marked as unreadable (Company ID {company_id})")
+            return status_row(company_id, "[unreadable content]")
 
-        translated_content = await translate_to_english_if_needed(text_content)
-        gpt_result = extract_with_gpt(translated_content)
+        try:
+            gpt_result = await asyncio.wait_for(extract_with_gpt(text_content), timeout=GPT_TIMEOUT)
+        except (asyncio.TimeoutError, *TRANSIENT_GPT_ERRORS) as e:
+            if is_quota_error(e):
+                request_stop(f"🛑 OpenAI quota exhausted, stopping run: {e}")
+                return None
+            print(f"⚠️ GPT unavailable for {name}, leaving for next run: {e!r}")
+            return None
+        except RUN_FATAL_GPT_ERRORS as e:
+            request_stop(f"🛑 GPT API Error, stopping run: {e}")
+            return None
 
         if gpt_result:
             print("🧠 Extracted:", json.dumps(gpt_result, indent=2, ensure_ascii=False))
-            save_to_db(company_id, gpt_result)
-        else:
-            print(f"⚠️ GPT failed for {name}. Marking as GPT fail.")
-            cur.execute("""
-                UPDATE companies
-                SET product_name = %s, product_function = '', product_location = '', product_qual = '', updated_at = NOW()
-                WHERE id = %s;
-            """, ("[gpt fail]", company_id))
-            conn.commit()
-            print(f"☠️ Marked as GPT fail (Company ID {company_id})")
+            domain_cache[key] = gpt_result
+            return build_row(company_id, gpt_result)
+
+        print(f"⚠️ GPT failed for {name}. Marking as GPT fail.")
+        print(f"☠️ Marked as GPT fail (Company ID {company_id})")
+        return status_row(company_id, "[gpt fail]")
 
     except Exception as e:
         print(f"❌ Fatal error for {name}: {e}")
+        return None
     finally:
         try:
-            await context.close()
-        except:
-            pass
-        try:
-            await browser.close()
+            await page.close()
         except:
             pass
 
 # === Main Execution ===
-async def main():
-    async with async_playwright() as playwright:
+async def produce_companies(queue):
+    last_id = START_ID - 1
+    try:
         while True:
             if stop_requested:
-                print("⏹️ Stop flag active. No more batches will be processed.")
+                print("⏹️ Stop flag active. No more companies will be queued.")
                 break
 
-            companies = fetch_companies(limit=MAX_CONCURRENT, start_from=START_ID)
+            companies = await asyncio.to_thread(fetch_companies, limit=FETCH_SIZE, after_id=last_id)
             if not companies:
-                print("✅ All companies processed!")
+                print("✅ All companies queued!")
                 break
 
-            tasks = [process_company(company, playwright) for company in companies]
+            for company in companies:
+                if stop_requested:
+                    break
+                await queue.put(company)
+            last_id = companies[-1][0]
+    finally:
+        # Always release the workers, even if a fetch failed
+        for _ in range(MAX_CONCURRENT):
+            await queue.put(None)
+
+async def flush_rows(pending):
+    rows = pending[:]
+    pending.clear()
+    await asyncio.to_thread(save_batch, rows)
+
+async def crawl_worker(queue, context, pending):
+    while True:
+        company = await queue.get()
+        try:
+            if company is None:
+                break
+            if stop_requested:
+                # Leave queued companies untouched; they stay NULL for the next run
+                continue
+            row = await process_company(company, context)
+            if row:
+                pending.append(row)
+            if len(pending) >= MAX_CONCURRENT:
+                await flush_rows(pending)
+        except Exception as e:
+            print(f"⚠️ Worker error: {e}")
+        finally:
+            queue.task_done()
 
+async def main():
+    async with async_playwright() as playwright:
+        await asyncio.to_thread(ensure_pending_index)
+        await asyncio.to_thread(ensure_gpt_cache)
+        browser = await playwright.chromium.launch(headless=True)
+        context = await browser.new_context(user_agent=USER_AGENT)
+        await context.route("**/*", block_heavy_requests)
+
+        queue = asyncio.Queue(maxsize=MAX_CONCURRENT * 2)
+        pending = []
+        try:
+            workers = [asyncio.create_task(crawl_worker(queue, context, pending)) for _ in range(MAX_CONCURRENT)]
             try:
-                await asyncio.gather(*tasks)
-            except Exception as e:
-                print(f"⚠️ Error while gathering tasks: {e}")
-
-        print("👋 Finished all running tasks. Exiting.")
+                await produce_companies(queue)
+            finally:
+                await asyncio.gather(*workers)
+                await flush_rows(pending)
+        finally:
+            await context.close()
+            await browser.close()
+            POOL.closeall()
+            await client.close()
+            print("👋 Finished all running tasks. Exiting.")
 
 if __name__ == "__main__":
     asyncio.run(main())